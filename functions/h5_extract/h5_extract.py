@@ -1,15 +1,122 @@
 import boto3
 import io
 import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 import h5py
 
 SNS_TOPIC = os.getenv('SNS_TOPIC')
+BLOCK_SIZE = int(os.getenv('BLOCK_SIZE', 256 * 1024))
+BLOCK_CACHE = int(os.getenv('BLOCK_CACHE', 64))
+RANGE_READS = os.getenv('RANGE_READS', '1') == '1'
+CHUNK_SIZE = 1024 * 1024
+SNS_WORKERS = int(os.getenv('SNS_WORKERS', 4))
+SNS_RETRIES = 5
+GROUPS_PER_MESSAGE = int(os.getenv('GROUPS_PER_MESSAGE', 1))
 s3 = boto3.client("s3")
 sns = boto3.client('sns')
 
 
+class S3File(io.RawIOBase):
+    """
+    Read-only file-like view of an S3 object for h5py.
+    Reads are served from BLOCK_SIZE blocks fetched with HTTP range requests,
+    so opening the file only pulls the superblock and group metadata.
+    """
+
+    def __init__(self, bucket, key, block_size=BLOCK_SIZE, cache_blocks=BLOCK_CACHE):
+        self.bucket = bucket
+        self.key = key
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.blocks = OrderedDict()
+        self.pos = 0
+        self.size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        return self.pos
+
+    def get_block(self, index):
+        block = self.blocks.get(index)
+        if block is not None:
+            self.blocks.move_to_end(index)
+            return block
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        obj = s3.get_object(Bucket=self.bucket, Key=self.key,
+                            Range="bytes=%d-%d" % (start, end))
+        block = obj["Body"].read()
+        self.fetched += len(block)
+        self.blocks[index] = block
+        if len(self.blocks) > self.cache_blocks:
+            self.blocks.popitem(last=False)
+        return block
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast("B")
+        count = 0
+        while count < len(view) and self.pos < self.size:
+            index, offset = divmod(self.pos, self.block_size)
+            block = self.get_block(index)
+            chunk = block[offset:offset + len(view) - count]
+            view[count:count + len(chunk)] = chunk
+            count += len(chunk)
+            self.pos += len(chunk)
+        return count
+
+
+def stream_to_file(body, fp, chunk_size=CHUNK_SIZE):
+    """
+    Copy an S3 StreamingBody into fp in fixed-size chunks so the object is
+    never held in memory twice.
+    """
+    shutil.copyfileobj(body, fp, chunk_size)
+    fp.seek(0)
+    return fp
+
+
+def publish_batch(messages):
+    """
+    Publish up to 10 messages with one PublishBatch call, resending only
+    the entries SNS reports as failed.
+    """
+    entries = [{"Id": str(i), "Message": m} for i, m in enumerate(messages)]
+    for attempt in range(SNS_RETRIES):
+        res = sns.publish_batch(
+            TopicArn=SNS_TOPIC,
+            PublishBatchRequestEntries=entries
+        )
+        failed = {f["Id"] for f in res.get("Failed", [])}
+        if not failed:
+            return
+        entries = [e for e in entries if e["Id"] in failed]
+        time.sleep(0.1 * 2 ** attempt)
+    raise RuntimeError("SNS publish failed for %s" % [e["Message"] for e in entries])
+
+
 def split_groups(dataset, infile, bucket):
     surf_cur_group = dataset["SurfaceCurrent"]
+    names = []
+    messages = []
     for key in surf_cur_group:
         if key == "axisNames":
             continue
@@ -17,11 +124,19 @@ def split_groups(dataset, infile, bucket):
         for name in data:
             if name == "uncertainty":
                 continue
-            data_path = "%s/%s/%s" % (bucket, infile, name)
-            sns.publish(
-                TargetArn=SNS_TOPIC,
-                Message=data_path
-            )
+            names.append(name)
+
+    # s111_manager accepts a comma separated batch of groups per message
+    for i in range(0, len(names), GROUPS_PER_MESSAGE):
+        data_path = "%s/%s/%s" % (bucket, infile, ",".join(names[i:i + GROUPS_PER_MESSAGE]))
+        messages.append(data_path)
+
+    batches = [messages[i:i + 10] for i in range(0, len(messages), 10)]
+    with ThreadPoolExecutor(max_workers=SNS_WORKERS) as executor:
+        for _ in executor.map(publish_batch, batches):
+            pass
+    print("Published %d groups in %d messages, %d batches" %
+          (len(names), len(messages), len(batches)))
 
 
 def lambda_handler(event, context):
@@ -29,13 +144,17 @@ def lambda_handler(event, context):
     bucket = event["Records"][0]["s3"]["bucket"]["name"]
     infile = event["Records"][0]["s3"]["object"]["key"]
 
-    obj = s3.get_object(Bucket=bucket, Key=infile)
-    body = obj["Body"].read()
-    data = io.BytesIO()
-    data.write(body)
-
-    dataset = h5py.File(data, "r")
-
-    split_groups(dataset, infile, bucket)
+    if RANGE_READS:
+        data = S3File(bucket, infile)
+        dataset = h5py.File(data, "r")
+        split_groups(dataset, infile, bucket)
+        print("Fetched %d of %d bytes" % (data.fetched, data.size))
+    else:
+        obj = s3.get_object(Bucket=bucket, Key=infile)
+        # h5py needs readinto(), which SpooledTemporaryFile lacks on 3.7
+        with tempfile.TemporaryFile(dir="/tmp") as data:
+            stream_to_file(obj["Body"], data)
+            dataset = h5py.File(data, "r")
+            split_groups(dataset, infile, bucket)
 
     return {"statusCode": 200, "body": "Complete"}
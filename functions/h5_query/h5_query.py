@@ -1,13 +1,17 @@
 from ftplib import FTP
 from datetime import datetime, timedelta
 from dateutil.parser import parse
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+import queue
 import re
-import io
 import os
 import boto3
 
 DATA_BUCKET = os.getenv('DATA_BUCKET')
 TIME_TABLE = os.getenv('TIME_TABLE')
+FTP_HOST = 'ocsftp.ncd.noaa.gov'
+FTP_WORKERS = int(os.getenv('FTP_WORKERS', 4))
 TZ_OFF = timedelta(hours=5)
 NOW = datetime.today()-TZ_OFF
 TODAY = NOW.strftime('%Y%m%d')
@@ -17,15 +21,121 @@ FILE_RE = re.compile(
     r".*((\d\d:\d\d)(AM|PM))[\ 0-9A-Z_]*Z_(.*)_TYP2(_PACIFIC|_ATLANTIC)?\.h5"
 )
 
+# Parts are read off the FTP socket and shipped as they fill. s3transfer
+# reads up to max_in_memory_upload_chunks parts ahead of a non-seekable
+# stream (10 by default), so cap it to keep each download to two 8 MiB
+# parts, 64 MiB across FTP_WORKERS=4. boto3's TransferConfig doesn't take
+# it as an argument, but the transfer manager reads the attribute.
+UPLOAD_CONFIG = TransferConfig(
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=2,
+)
+UPLOAD_CONFIG.max_in_memory_upload_chunks = 2
+
 dynamodb = boto3.client('dynamodb')
 s3 = boto3.client("s3")
 
 
-def get_lastest():
-    ftp = FTP('ocsftp.ncd.noaa.gov')
+def ftp_connect():
+    ftp = FTP(FTP_HOST)
     ftp.login()
     ftp.cwd(BASE_DIR)
+    return ftp
+
+
+class FTPPool:
+    """
+    Logged in FTP connections shared by the download workers, at most one
+    per worker thread. Connections are opened lazily and broken ones dropped.
+    """
+
+    def __init__(self):
+        self.idle = queue.Queue()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return ftp_connect()
+
+    def release(self, ftp, broken=False):
+        if broken:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+        else:
+            self.idle.put(ftp)
+
+    def close(self):
+        while not self.idle.empty():
+            try:
+                self.idle.get_nowait().quit()
+            except Exception:
+                pass
+
+
+def get_stamps(datasets):
+    """
+    Resolve the last_updated stamp of every dataset with BatchGetItem,
+    100 keys per request. Datasets never seen before are left out.
+    """
+    stamps = {}
+    datasets = list(datasets)
+    for i in range(0, len(datasets), 100):
+        request = {
+            TIME_TABLE: {
+                "Keys": [{"dataset": {"S": d}} for d in datasets[i:i + 100]]
+            }
+        }
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(TIME_TABLE, []):
+                stamps[item["dataset"]["S"]] = float(item["last_updated"]["S"])
+            request = response.get("UnprocessedKeys")
+    return stamps
+
+
+def put_stamp(data_short, data_time):
+    """
+    Record a dataset's new last_updated stamp. Called as soon as its upload
+    lands, so json2mvt never tiles a fresh object against a stale stamp.
+    """
+    dynamodb.put_item(
+        TableName=TIME_TABLE,
+        Item={
+            'dataset': {
+                "S": data_short
+            },
+            'last_updated': {
+                "S": str(data_time.timestamp())
+            }
+        })
+
+
+def download(pool, region, filename, data_short, data_time):
+    print("Updating:", data_short)
+    ftp = pool.acquire()
+    try:
+        ftp.voidcmd('TYPE I')
+        conn = ftp.transfercmd('RETR %s/%s' % (region, filename))
+        with conn, conn.makefile('rb') as stream:
+            s3.upload_fileobj(stream, DATA_BUCKET, data_short,
+                              Config=UPLOAD_CONFIG)
+        ftp.voidresp()
+    except Exception:
+        pool.release(ftp, broken=True)
+        raise
+    pool.release(ftp)
+    put_stamp(data_short, data_time)
+    print("Updated:", data_short)
+    return data_short, data_time
+
+
+def get_lastest():
+    ftp = ftp_connect()
     regions = ftp.nlst()
+    candidates = {}
     for region in regions:
         print("-", region)
         checked_files = []
@@ -42,40 +152,28 @@ def get_lastest():
         for x in checked_files:
             res = FILE_RE.match(x)
             data_short = res.group(4)
-            data_time = res.group(1)
-            response = dynamodb.get_item(
-                TableName=TIME_TABLE,
-                Key={
-                    "dataset": {
-                        "S": data_short
-                    }
-                }
-            )
-            data_time = parse(TODAY_F + " " + data_time)
-            refresh = ("Item" not in response or
-                       float(response["Item"]["last_updated"]["S"]) < data_time.timestamp())
-            if refresh:
-                print("Updating:", data_short)
-                data = io.BytesIO()
-                ftp.retrbinary(
-                    'RETR %s/%s' % (region, x.split(" ")[-1]),
-                    data.write)
-
-                s3.put_object(
-                    Bucket=DATA_BUCKET,
-                    Key=data_short,
-                    Body=data.getvalue())
-
-                dynamodb.put_item(
-                    TableName=TIME_TABLE,
-                    Item={
-                        'dataset': {
-                            "S": data_short
-                        },
-                        'last_updated': {
-                            "S": str(data_time.timestamp())
-                        }
-                    })
+            data_time = parse(TODAY_F + " " + res.group(1))
+            if (data_short not in candidates or
+                    candidates[data_short][2] < data_time):
+                candidates[data_short] = (region, x.split(" ")[-1], data_time)
+    ftp.quit()
+
+    stamps = get_stamps(candidates)
+    pool = FTPPool()
+    with ThreadPoolExecutor(max_workers=FTP_WORKERS) as executor:
+        jobs = [
+            executor.submit(download, pool, region, filename,
+                            data_short, data_time)
+            for data_short, (region, filename, data_time) in candidates.items()
+            if stamps.get(data_short, float("-inf")) < data_time.timestamp()
+        ]
+    pool.close()
+
+    failed = [job.exception() for job in jobs if job.exception() is not None]
+    for error in failed:
+        print("Failed:", error)
+    if failed:
+        raise failed[0]
 
 
 def lambda_handler(event, context):
@@ -2,7 +2,11 @@ import json
 import boto3
 import os
 import re
+import math
 import subprocess
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 """
 Python TippeCanoe binary wrapper.
@@ -15,38 +19,226 @@ from mbutil import mbtiles_to_disk
 s3_client = boto3.client("s3")
 dynamodb = boto3.client("dynamodb")
 TIME_TABLE = os.getenv("TIME_TABLE")
+STREAM_INPUT = os.getenv("STREAM_INPUT", "0") == "1"
+TILE_BY_ZOOM = os.getenv("TILE_BY_ZOOM", "0") == "1"
+THIN_BY_LEVEL = os.getenv("THIN_BY_LEVEL", "0") == "1"
+THIN_MIN_PIXELS = float(os.getenv("THIN_MIN_PIXELS", 16))
+AUTO_PIXELS = float(os.getenv("AUTO_PIXELS", 8))
+AUTO_MAX_ZOOM = 18
+CHUNK_SIZE = 1024 * 1024
+if STREAM_INPUT and (TILE_BY_ZOOM or THIN_BY_LEVEL):
+    # Both rewrite or re-read the staged GeoJSON, which streaming never writes
+    raise ValueError("STREAM_INPUT can't be combined with TILE_BY_ZOOM or THIN_BY_LEVEL")
 
+"""
+Tiling profiles per model, looked up by the dataset name (the Bucket2
+folder). Keys:
+  min_zoom, max_zoom  zoom range, max_zoom may be "auto" to derive it
+                      from the vertex spacing of the GeoJSON
+  auto_max            ceiling for "auto", and its value when the GeoJSON
+                      isn't staged
+  flags               tippecanoe flags
+  drop                tippecanoe drop strategy, e.g. "drop-densest-as-needed"
+  tile_budget         expected tile count, runs above it are logged
+The per-model profiles live in TILING_PROFILES (JSON), set in the
+template Globals so streamlinesprocessor, which simplifies for each
+model's max zoom, reads the same registry. Only the defaults are here.
+"""
+PROFILES = {
+    "default": {
+        "min_zoom": 4,
+        "max_zoom": 12,
+        "auto_max": AUTO_MAX_ZOOM,
+        "flags": ["-pk", "-pc", "-pD"],
+        "drop": None,
+        "tile_budget": None,
+    },
+}
+for name, overrides in json.loads(os.getenv("TILING_PROFILES", "{}")).items():
+    PROFILES.setdefault(name, {}).update(overrides)
+
+
+def get_profile(model):
+    """Profile for a model, falling back to "default" for unset keys"""
+    profile = dict(PROFILES["default"])
+    if model not in PROFILES:
+        # Names such as "RTOFS_ATLANTIC" share their model's profile
+        model = next((m for m in PROFILES if m != "default" and m in model), "default")
+    profile.update(PROFILES[model])
+    profile["name"] = model
+    return profile
+
+
+def auto_max_zoom(path, min_zoom, ceiling, seq=False):
+    """
+    Deepest zoom worth building: the one at which the median distance
+    between streamline vertices, set by the model's grid, reaches
+    AUTO_PIXELS screen pixels. Zooms past it add no detail.
+    """
+    with open(path) as fp:
+        if seq:
+            features = [json.loads(line) for line in fp if line.strip()]
+        else:
+            features = json.load(fp)["features"]
+    steps = []
+    for f in features:
+        coords = f["geometry"]["coordinates"]
+        for a, b in zip(coords, coords[1:]):
+            scale = math.cos(math.radians(a[1]))
+            steps.append(math.hypot(b[0] - a[0], (b[1] - a[1]) / scale))
+    steps = sorted(s for s in steps if s > 0)
+    if not steps:
+        return min_zoom
+    median = steps[len(steps) // 2]
+    zoom = math.ceil(math.log2(360.0 * AUTO_PIXELS / (256 * median)))
+    return min(max(zoom, min_zoom), ceiling)
+
+
+def resolve_profile(model, path=None, seq=False):
+    """get_profile with an "auto" max_zoom turned into a number"""
+    profile = get_profile(model)
+    if profile["max_zoom"] == "auto":
+        if path is not None and os.path.exists(path):
+            profile["max_zoom"] = auto_max_zoom(path, profile["min_zoom"], profile["auto_max"], seq)
+        else:
+            profile["max_zoom"] = profile["auto_max"]
+    print("Profile %s: zoom %d-%d" % (profile["name"], profile["min_zoom"], profile["max_zoom"]))
+    return profile
 
-def gen_mbtiles(infile):
+
+def zoom_range(profile):
+    return profile["min_zoom"], profile["max_zoom"]
+
+
+def level_minzoom(level, dSep, lat, min_zoom, max_zoom):
+    """
+    First zoom at which streamlines of a level sit THIN_MIN_PIXELS apart.
+    Level L is seeded dSep * 2 ** -L metres apart, so each finer level
+    shows up one zoom later.
+    """
+    sep = dSep * 2 ** -level
+    mpp = 156543.03 * math.cos(math.radians(lat))
+    zoom = math.ceil(math.log2(THIN_MIN_PIXELS * mpp / sep))
+    return min(max(zoom, min_zoom), max_zoom)
+
+
+def thin_by_level(path, min_zoom, max_zoom, seq=False):
+    """
+    Tag each streamline with a tippecanoe.minzoom derived from its
+    streamline_level and dSep so low zooms only carry coarse streamlines.
+    The coarsest level is always kept. seq marks GeoJSONSeq input.
+    """
+    with open(path) as fp:
+        if seq:
+            features = [json.loads(line) for line in fp if line.strip()]
+        else:
+            obj = json.load(fp)
+            features = obj["features"]
+    if not features:
+        return
+    coords = [c for f in features for c in f["geometry"]["coordinates"][:1]]
+    lat = sum(c[1] for c in coords) / len(coords)
+    coarsest = min(f["properties"]["streamline_level"] for f in features)
+    counts = {}
+    for f in features:
+        props = f["properties"]
+        if props["streamline_level"] == coarsest:
+            zoom = min_zoom
+        else:
+            zoom = level_minzoom(props["streamline_level"], props["dSep"], lat, min_zoom, max_zoom)
+        f["tippecanoe"] = {"minzoom": zoom}
+        counts[zoom] = counts.get(zoom, 0) + 1
+    print("Thinned by level, features per minzoom:", sorted(counts.items()))
+    with open(path, "w") as fp:
+        if seq:
+            fp.write("\n".join(json.dumps(f, separators=(",", ":")) for f in features) + "\n")
+        else:
+            json.dump(obj, fp, separators=(",", ":"))
+
+
+def gen_mbtiles(infile, profile, parallel=False, stream=False, zoom=None):
     env = os.environ.copy()
-    max_zoom = 12
-    min_zoom = 4
-    if "NYOFS" in infile:
-        max_zoom = 18
-        min_zoom = 4
-    if "RTOFS" in infile:
-        max_zoom = 10
-        min_zoom = 3
+    min_zoom, max_zoom = zoom_range(profile)
+    outfile = "/tmp/" + infile + ".mbtiles"
 
-    env["LD_LIBRARY_PATH"] = "/opt/lib"
-    process = subprocess.Popen(
-        [
-            "/opt/tippecanoe",
-            "-o",
-            "/tmp/" + infile + ".mbtiles",
-            "/tmp/" + infile + ".geojson",
+    args = [
+        "/opt/tippecanoe",
+        "-o",
+        outfile,
+        # A failed attempt may have left this tileset in /tmp on a warm
+        # container, let the retry overwrite it
+        "--force",
+    ] + profile["flags"]
+    if profile["drop"]:
+        args.append("--" + profile["drop"])
+    if zoom is None:
+        args += [
             "--maximum-zoom={}".format(max_zoom),
             "--minimum-zoom={}".format(min_zoom),
-            "-pk",
-            "-pc",
-            "-pD",
-        ],
+        ]
+    else:
+        # Single zoom level run, base zoom pinned so it matches a full run
+        args[2] = outfile = "/tmp/{}-{}.mbtiles".format(infile, zoom)
+        args += [
+            "--maximum-zoom={}".format(zoom),
+            "--minimum-zoom={}".format(zoom),
+            "--base-zoom={}".format(max_zoom),
+            "-q",
+        ]
+    if stream:
+        # With no input file tippecanoe reads stdin. Progress output is
+        # silenced so an unread stderr pipe cannot block it mid-stream.
+        args.append("-q")
+    else:
+        args.append("/tmp/" + infile + ".geojson")
+        if parallel:
+            # Line delimited input (GeoJSONSeq) can be split across threads
+            args.append("-P")
+
+    env["LD_LIBRARY_PATH"] = "/opt/lib"
+    process = subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE if stream else None,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         env=env,
     )
 
-    return process
+    return process, outfile
+
+
+def check_budget(profile, count):
+    if profile["tile_budget"] and count > profile["tile_budget"]:
+        print("Tile budget exceeded for %s: %d tiles, expected %d" %
+              (profile["name"], count, profile["tile_budget"]))
+
+
+def tile_by_zoom(infile, profile, parallel, loc, update_time):
+    """
+    Run tippecanoe one zoom level at a time, lowest first, and hand each
+    finished MBTiles file to an egress worker so DynamoDB writes for one
+    level overlap tiling of the next.
+    """
+    min_zoom, max_zoom = zoom_range(profile)
+
+    def egress(mbtiles_file):
+        count = mbtiles_to_disk(mbtiles_file, loc, update_time)
+        os.remove(mbtiles_file)
+        print("Egressed", mbtiles_file)
+        return count
+
+    jobs = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for zoom in range(min_zoom, max_zoom + 1):
+            process, outfile = gen_mbtiles(infile, profile, parallel, zoom=zoom)
+            _, err = process.communicate()
+            if process.returncode != 0:
+                # Fail the invocation so the S3 event is retried rather
+                # than leaving this zoom level untiled
+                raise RuntimeError("tippecanoe failed on zoom %d: %s" %
+                                   (zoom, err.decode("utf-8", "replace")))
+            jobs.append(executor.submit(egress, outfile))
+    check_budget(profile, sum(job.result() for job in jobs))
 
 
 def lambda_handler(event, context):
@@ -60,20 +252,65 @@ def lambda_handler(event, context):
     )
 
     data_location = infile.split("/")[0]
+    parallel = infile.endswith(".geojsons")
     infile = (infile.replace("/", "")).split(".")[0]
 
     print("Infile is " + data_location + "-" + str(int(re.findall(r"\d+", infile)[0])))
 
-    geoJson = s3_obj["Body"].read()
-    localCache = open("/tmp/" + infile + ".geojson", "wb")
-    localCache.write(geoJson)
-    localCache.close()
+    if STREAM_INPUT:
+        """
+        Feed the S3 body to tippecanoe while it is still downloading
+        """
+        body = s3_obj["Body"]
+        if s3_obj.get("ContentEncoding") == "gzip":
+            body = gzip.GzipFile(fileobj=body)
+        profile = resolve_profile(data_location)
+        process, _ = gen_mbtiles(infile, profile, stream=True)
+        try:
+            with process.stdin:
+                shutil.copyfileobj(body, process.stdin, CHUNK_SIZE)
+        except BrokenPipeError:
+            # tippecanoe exited early, its exit status says why
+            pass
+        if process.wait() != 0:
+            raise RuntimeError("tippecanoe failed on %s: %s" %
+                               (infile, process.stderr.read().decode("utf-8", "replace")))
+    else:
+        geoJson = s3_obj["Body"].read()
+        if s3_obj.get("ContentEncoding") == "gzip":
+            geoJson = gzip.decompress(geoJson)
+        localCache = open("/tmp/" + infile + ".geojson", "wb")
+        localCache.write(geoJson)
+        localCache.close()
+        profile = resolve_profile(data_location, "/tmp/" + infile + ".geojson", parallel)
+        if THIN_BY_LEVEL:
+            min_zoom, max_zoom = zoom_range(profile)
+            thin_by_level("/tmp/" + infile + ".geojson", min_zoom, max_zoom, parallel)
 
-    """
-    Generate MBTile & store it at: /tmp/tmp.mbtiles
-    """
-    process = gen_mbtiles(infile)
-    process.wait()
+        """
+        Generate MBTile & store it at: /tmp/tmp.mbtiles
+        """
+        if TILE_BY_ZOOM:
+            response = dynamodb.get_item(
+                TableName=TIME_TABLE, Key={"dataset": {"S": data_location}}
+            )
+            if "Item" not in response:
+                return {"statusCode": 404, "body": "Failed time table lookup"}
+            tile_by_zoom(
+                infile,
+                profile,
+                parallel,
+                data_location + "-" + str(int(re.findall(r"\d+", infile)[0])),
+                response["Item"]["last_updated"]["S"],
+            )
+            os.remove("/tmp/" + infile + ".geojson")
+            return {
+                "statusCode": 200,
+                "body": json.dumps("Processed GeoJSON to MVT and pushed to Lambda"),
+            }
+
+        process, _ = gen_mbtiles(infile, profile, parallel)
+        process.wait()
 
     print("MBTILE Generated")
 
@@ -86,11 +323,12 @@ def lambda_handler(event, context):
     """
     Slice MBTile here
     """
-    mbtiles_to_disk(
+    count = mbtiles_to_disk(
         "/tmp/" + infile + ".mbtiles",
         data_location + "-" + str(int(re.findall(r"\d+", infile)[0])),
         response["Item"]["last_updated"]["S"],
     )
+    check_budget(profile, count)
     # In testing Lambda disk was full when this function was slammed
     # /tmp acks as a temporary cache between invocations so
     # we should cleanup a bit
@@ -4,7 +4,26 @@ import logging
 import os
 import json
 import math
+import io
+import gzip
+import hashlib
+import time
+import threading
+import queue
 import boto3
+from itertools import chain
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
 Code Adapted from MBUTIL
@@ -12,8 +31,21 @@ Code Adapted from MBUTIL
 Modified into a cloud-native SQL Egress via Lambda to AWS DynamoDB
 """
 
-dynamodb = boto3.resource("dynamodb")
-dynamodb_table = dynamodb.Table(os.getenv("DATA_TABLE"))
+DATA_TABLE = os.getenv("DATA_TABLE")
+EGRESS_WORKERS = int(os.getenv("EGRESS_WORKERS", 4))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 4))
+MAX_PENDING_UPLOADS = 16
+DEDUP = os.getenv("DEDUP", "0") == "1"
+# Blobs are rewritten by every run that uses them, so one no run has
+# touched for this long is unreferenced. Keep in step with the Bucket3
+# blob- lifecycle rule in template.yaml.
+BLOB_TTL_DAYS = int(os.getenv("BLOB_TTL_DAYS", 7))
+TILE_CODEC = os.getenv("TILE_CODEC", "gzip")
+TILE_LEVEL = os.getenv("TILE_LEVEL")
+DYNAMO_LIMIT = 400000
+FETCH_SIZE = int(os.getenv("FETCH_SIZE", 500))
+MMAP_SIZE = 256 * 1024 * 1024
+MAX_RETRIES = 8
 huge_bucket = os.getenv("DATA_BUCKET")
 s3 = boto3.client("s3")
 
@@ -23,9 +55,15 @@ logger = logging.getLogger(__name__)
 def flip_y(zoom, y):
     return (2 ** zoom - 1) - y
 
-def mbtiles_connect(mbtiles_file):
+def mbtiles_connect(mbtiles_file, readonly=False):
     try:
-        con = sqlite3.connect(mbtiles_file)
+        if readonly:
+            # tippecanoe has finished with the file, so skip locking and
+            # change detection and let SQLite map the pages directly
+            con = sqlite3.connect("file:%s?mode=ro&immutable=1" % mbtiles_file, uri=True)
+            con.execute("pragma mmap_size=%d;" % MMAP_SIZE)
+        else:
+            con = sqlite3.connect(mbtiles_file)
         print("Grabbed SQLite Connction")
         return con
     except Exception as e:
@@ -34,8 +72,338 @@ def mbtiles_connect(mbtiles_file):
         sys.exit(1)
 
 
-def mbtiles_to_disk(mbtiles_file, loc, update_time, **kwargs):
-    con = mbtiles_connect(mbtiles_file)
+class EgressStats:
+    """Thread safe throughput counters shared by the egress workers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.items = 0
+        self.bytes = 0
+        self.retries = 0
+
+    def add(self, items=0, size=0, retries=0):
+        with self.lock:
+            self.items += items
+            self.bytes += size
+            self.retries += retries
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        print("Egress: %d items, %d bytes, %d retries in %.1fs (%.0f items/s, %.0f bytes/s)" % (
+            self.items, self.bytes, self.retries, elapsed,
+            self.items / elapsed, self.bytes / elapsed))
+
+
+class TileWriter:
+    """
+    Per worker DynamoDB batch writer. Flushes 25 items per BatchWriteItem
+    and resends UnprocessedItems with exponential backoff. An item put with
+    a done future resolves it once the item is stored. size is the tile
+    body the item stands for, which for S3 tiles and dedup pointers is not
+    the placeholder in its tile attribute.
+    """
+
+    def __init__(self, stats):
+        self.dynamodb = boto3.session.Session().resource("dynamodb")
+        self.stats = stats
+        self.buffer = []
+        self.done = []
+        self.size = 0
+
+    def put(self, entry, done=None, size=None):
+        self.buffer.append({"PutRequest": {"Item": entry}})
+        self.size += len(entry["tile"]) if size is None else size
+        if done is not None:
+            self.done.append(done)
+        if len(self.buffer) >= 25:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        request = {DATA_TABLE: self.buffer}
+        items = len(self.buffer)
+        size = self.size
+        done = self.done
+        self.buffer = []
+        self.done = []
+        self.size = 0
+        try:
+            for attempt in range(MAX_RETRIES):
+                res = self.dynamodb.batch_write_item(RequestItems=request)
+                request = res.get("UnprocessedItems")
+                if not request:
+                    self.stats.add(items=items, size=size)
+                    for future in done:
+                        future.set_result(None)
+                    return
+                self.stats.add(retries=1)
+                time.sleep(min(0.05 * 2 ** attempt, 5))
+            raise RuntimeError("DynamoDB kept %d items unprocessed" % len(request[DATA_TABLE]))
+        except Exception as e:
+            fail(done, e)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.flush()
+        else:
+            # Never leave other workers waiting on items that won't be written
+            fail(self.done, exc[1])
+
+
+def fail(futures, error):
+    for future in futures:
+        if not future.done():
+            future.set_exception(error)
+
+
+class UploadPool:
+    """
+    Bounded pool for tiles too large for DynamoDB. At most max_pending
+    tiles are held in memory waiting for S3, and uploads run next to the
+    DynamoDB batching instead of stalling it.
+    """
+
+    def __init__(self, workers=UPLOAD_WORKERS, max_pending=MAX_PENDING_UPLOADS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, key, data):
+        self.slots.acquire()
+        future = self.executor.submit(s3.upload_fileobj, io.BytesIO(data), huge_bucket, key)
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class TieringPolicy:
+    """
+    Decides how tile bodies are encoded and where they are stored.
+    Tiles are re-compressed with codec ("gzip" or "zstd") at level, and
+    anything still larger than limit once compressed spills to S3.
+    Tippecanoe's gzip bytes are kept as they are for gzip with no level.
+    """
+
+    def __init__(self, codec=TILE_CODEC, level=TILE_LEVEL, limit=DYNAMO_LIMIT):
+        if codec not in ("gzip", "zstd"):
+            raise ValueError("Unknown tile codec: %s" % codec)
+        if codec == "zstd" and zstandard is None:
+            raise RuntimeError("TILE_CODEC=zstd needs the zstandard package")
+        self.codec = codec
+        self.level = None if level is None else int(level)
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.tiers = {"dynamodb": [0, 0], "s3": [0, 0]}
+
+    def encode(self, data):
+        if self.codec == "gzip" and self.level is None:
+            return data
+        if data[:2] == b"\x1f\x8b":
+            data = gzip.decompress(data)
+        if self.codec == "gzip":
+            # mtime=0 keeps the bytes, and so the dedup digests, stable
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=self.level, mtime=0) as fp:
+                fp.write(data)
+            return buf.getvalue()
+        return zstandard.ZstdCompressor(level=3 if self.level is None else self.level).compress(data)
+
+    def tier(self, data):
+        tier = "s3" if len(data) > self.limit else "dynamodb"
+        with self.lock:
+            self.tiers[tier][0] += 1
+            self.tiers[tier][1] += len(data)
+        return tier
+
+    def report(self):
+        for tier, (count, size) in self.tiers.items():
+            print("Tier %s: %d tiles, %d bytes (%s)" % (tier, count, size, self.codec))
+
+
+def tile_entry(t, loc, update_time, policy):
+    """Returns the DynamoDB item for a tile and its encoded body"""
+    z = t[0]
+    x = t[1]
+    y = flip_y(z, t[2])
+    """Push T file to DynamoDB"""
+    key = str(loc + "-" + str(z) + "-" + str(x) + "-" + str(y))
+    data = policy.encode(t[3])
+    entry = {}
+    entry["tileKey"] = key
+    entry["tile"] = data
+    entry["huge"] = policy.tier(data) == "s3"
+    entry["codec"] = policy.codec
+    entry["timestamp"] = update_time
+    if entry["huge"]:
+        print("Miss:", key, len(data))
+        entry["tile"] = str.encode("a") #need non-null
+    return entry, data
+
+
+class BlobIndex:
+    """
+    Tracks which tile bodies this run has already stored under
+    blob-<sha1>, so each unique body is written once. Every blob gets a
+    future, registered when it is claimed, that resolves once its item
+    (and for huge blobs its S3 object) is stored, so pointers to it can
+    wait for it whichever worker writes them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs = {}
+
+    def claim(self, digest):
+        """Returns (first caller?, future of the stored blob)"""
+        with self.lock:
+            if digest in self.blobs:
+                return False, self.blobs[digest]
+            future = self.blobs[digest] = Future()
+            return True, future
+
+
+def dedup_entries(data, entry, blobs, uploads, batch, pending):
+    """
+    Store the tile body once as a blob item and point entry at it by hash.
+    The pointer is queued until the blob is stored, a huge blob's item in
+    turn waits for its S3 upload.
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    first, stored = blobs.claim(digest)
+    if first:
+        blob = {
+            "tileKey": "blob-" + digest,
+            "tile": data,
+            "huge": entry["huge"],
+            "codec": entry["codec"],
+            # DynamoDB TTL attribute, epoch seconds
+            "expires": int(time.time()) + BLOB_TTL_DAYS * 86400,
+        }
+        if blob["huge"]:
+            blob["tile"] = str.encode("a") #need non-null
+            # The pointers account for the body, so the blob counts as 0
+            pending.append((uploads.submit(blob["tileKey"], data), blob, stored, 0))
+        else:
+            batch.put(blob, stored, 0)
+    entry["hash"] = digest
+    entry["huge"] = False
+    entry["tile"] = str.encode("a") #need non-null
+    if stored.done():
+        stored.result()
+        batch.put(entry, size=len(data))
+    else:
+        pending.append((stored, entry, None, len(data)))
+
+
+def put_uploaded(pending, batch):
+    """
+    Write the items whose dependency (an S3 upload or a blob item) has been
+    stored, so readers never find a pointer without its object. Returns
+    the rest. done, if set, is resolved once the item itself is written.
+    """
+    waiting = []
+    for future, entry, done, size in pending:
+        if future.done():
+            try:
+                future.result()
+            except Exception as e:
+                fail([done] if done else [], e)
+                raise
+            batch.put(entry, done, size)
+        else:
+            waiting.append((future, entry, done, size))
+    return waiting
+
+
+def drain(pending, batch):
+    """
+    Wait out the pending items. The buffer is flushed before every wait
+    since other workers, or this one, may be waiting on items held in it.
+    """
+    while pending:
+        pending = put_uploaded(pending, batch)
+        batch.flush()
+        if pending:
+            wait([future for future, _, _, _ in pending], return_when=FIRST_COMPLETED)
+
+
+def read_tiles(con, size=FETCH_SIZE):
+    """
+    Yield every tile lowest zoom first, so the most requested tiles become
+    servable earliest, fetching size rows per round trip into SQLite.
+    """
+    tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles '
+                        'order by zoom_level;')
+    rows = tiles.fetchmany(size)
+    while rows:
+        yield rows
+        rows = tiles.fetchmany(size)
+
+
+def feed(chunks, chunk, jobs):
+    """Queue chunk for the workers, giving up if one of them has failed"""
+    while True:
+        try:
+            chunks.put(chunk, timeout=1)
+            return
+        except queue.Full:
+            for job in jobs:
+                if job.done() and job.exception() is not None:
+                    raise job.exception()
+
+
+def abort(chunks, workers):
+    """Drop the queued chunks and stop every worker"""
+    while workers:
+        try:
+            chunks.put_nowait(None)
+            workers -= 1
+        except queue.Full:
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def egress_worker(chunks, loc, update_time, stats, uploads, blobs, policy):
+    """Push the chunks taken off the shared queue through one writer"""
+    pending = []
+    rows = 0
+    work_time = 0.0
+    with TileWriter(stats) as batch:
+        try:
+            for chunk in iter(chunks.get, None):
+                start = time.time()
+                for t in chunk:
+                    entry, data = tile_entry(t, loc, update_time, policy)
+                    if DEDUP:
+                        dedup_entries(data, entry, blobs, uploads, batch, pending)
+                    elif entry["huge"]:
+                        pending.append((uploads.submit(entry["tileKey"], data), entry, None, len(data)))
+                    else:
+                        batch.put(entry)
+                    if pending:
+                        pending = put_uploaded(pending, batch)
+                rows += len(chunk)
+                work_time += time.time() - start
+            drain(pending, batch)
+        except Exception as e:
+            fail([done for _, _, done, _ in pending if done is not None], e)
+            raise
+    # work_time includes the DynamoDB flushes made from this thread
+    print("Worker: %d tiles, process %.2fs (%.1f us/row)" % (
+        rows, work_time, 1e6 * work_time / max(rows, 1)))
+
+
+def mbtiles_to_disk(mbtiles_file, loc, update_time, workers=EGRESS_WORKERS, policy=None, **kwargs):
+    con = mbtiles_connect(mbtiles_file, readonly=True)
 
     # metadata = dict(con.execute('select name, value from metadata;').fetchall())
     # json.dump(metadata, open(os.path.join(directory_path, 'metadata.json'), 'w'), indent=4)
@@ -50,33 +418,52 @@ def mbtiles_to_disk(mbtiles_file, loc, update_time, **kwargs):
     #     formatter_json = {"formatter":formatter}
     #     open(layer_json, 'w').write(json.dumps(formatter_json))
 
-    """Grab Tiles and Process to DynamoDB"""
-    tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles;')
-    t = tiles.fetchone()
-    with dynamodb_table.batch_writer() as batch:
-        while t:
-            z = t[0]
-            x = t[1]
-            y = flip_y(z, t[2])
-            """Push T file to DynamoDB"""
-            key = str(loc + "-" + str(z) + "-" + str(x) + "-" + str(y))
-            entry = {}
-            entry["tileKey"] = key
-            entry["tile"] = t[3]
-            entry["huge"] = len(t[3]) > 400000
-            entry["timestamp"] = update_time
-            if not entry["huge"]:
-                batch.put_item(Item=entry)
-            else:
-                print("Miss:", key, len(t[3]))
-                s3.put_object(
-                        Bucket=huge_bucket,
-                        Key=key,
-                        Body=t[3])
-                entry["tile"] = str.encode("a") #need non-null
-                batch.put_item(Item=entry)
-
-            t = tiles.fetchone()
+    """
+    Grab Tiles and Process to DynamoDB. One reader walks the tiles in
+    global zoom order and the workers share its chunks, so every worker
+    is on the lowest zoom not yet written.
+    """
+    if count == 0:
+        con.close()
+        return 0
+    stats = EgressStats()
+    uploads = UploadPool()
+    blobs = BlobIndex()
+    if policy is None:
+        policy = TieringPolicy()
+    chunks = queue.Queue(maxsize=2 * workers)
+    rows = 0
+    read_time = 0.0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [
+            executor.submit(egress_worker, chunks, loc, update_time, stats, uploads, blobs, policy)
+            for _ in range(workers)
+        ]
+        try:
+            start = time.time()
+            for chunk in read_tiles(con):
+                read_time += time.time() - start
+                rows += len(chunk)
+                feed(chunks, chunk, jobs)
+                start = time.time()
+            for _ in jobs:
+                feed(chunks, None, jobs)
+        except BaseException:
+            abort(chunks, len(jobs))
+            raise
+        finally:
+            con.close()
+    uploads.shutdown()
+    for job in jobs:
+        job.result()
+    print("Read %d tiles in %.2fs (%.1f us/row)" % (rows, read_time, 1e6 * read_time / max(rows, 1)))
+    if DEDUP:
+        print("Dedup: %d unique tile bodies of %d" % (len(blobs.blobs), count))
+    stats.report()
+    policy.report()
+    return count
+
+
 def angle3pt(a, b, c):
     ang = math.degrees(math.atan2(c[1]-b[1], c[0]-b[0]) - math.atan2(a[1]-b[1], a[0]-b[0]))
     return ang + 360 if ang < 0 else ang
@@ -127,3 +514,77 @@ def json_filter(obj):
         feat["geometry"]["properties"] = nProps
         new_obj["features"].append(feat)
     return new_obj
+
+
+def turning_angles(pts):
+    """angle3pt for every consecutive vertex triple of an (N, 2) array"""
+    a, b, c = pts[:-2], pts[1:-1], pts[2:]
+    ang = np.degrees(np.arctan2(c[:, 1] - b[:, 1], c[:, 0] - b[:, 0]) -
+                     np.arctan2(a[:, 1] - b[:, 1], a[:, 0] - b[:, 0]))
+    return np.where(ang < 0, ang + 360, ang)
+
+
+def pick(values, idx):
+    return list(itemgetter(*idx)(values)) if len(idx) > 1 else [values[i] for i in idx]
+
+
+def json_filter_np(obj):
+    """
+    NumPy version of json_filter with identical output, which stays the
+    reference. Turning angles for every (2D) vertex of every feature are
+    computed in one shot over the concatenated lines. A vertex is dropped
+    when the turn before it exceeds 270 degrees, and the second to last
+    vertex is never kept, as in the loop.
+    """
+    if np is None:
+        raise RuntimeError("json_filter_np needs numpy")
+    new_obj = {"type": "FeatureCollection", "bbox": obj["bbox"], "features": []}
+    feats = [(x, f) for x, f in enumerate(obj["features"])
+             if len(f["geometry"]["coordinates"]) > 4]
+    if not feats:
+        return new_obj
+    lengths = np.array([len(f["geometry"]["coordinates"]) for _, f in feats])
+    ends = np.cumsum(lengths) - 1
+    starts = ends - lengths + 1
+    total = int(lengths.sum())
+    pts = np.fromiter(
+        chain.from_iterable(chain.from_iterable(f["geometry"]["coordinates"] for _, f in feats)),
+        dtype=float, count=2 * total).reshape(-1, 2)
+
+    # drop[i] is the skip decision of the triple starting at vertex i,
+    # triples straddling two features are overwritten below
+    drop = np.zeros(total, dtype=bool)
+    drop[:-2] = turning_angles(pts) > 270
+    keep = np.ones(total, dtype=bool)
+    keep[1:] = ~drop[:-1]
+    keep[starts] = True
+    keep[ends - 1] = False
+    keep[ends] = ~drop[ends - 2]
+
+    # Kept vertex indices local to their feature, split per feature below
+    counts = np.add.reduceat(keep, starts)
+    local = (np.flatnonzero(keep) - np.repeat(starts, counts)).tolist()
+    bounds = np.concatenate(([0], np.cumsum(counts))).tolist()
+
+    for i, (x, feature) in enumerate(feats):
+        idx = local[bounds[i]:bounds[i + 1]]
+        coords = feature["geometry"]["coordinates"]
+        props = feature["properties"]
+        nProps = {
+                "index": props["index"],
+                "streamline_level": props["streamline_level"],
+                "seed_index": props["seed_index"],
+                "point_levels": pick(props["point_levels"], idx),
+                "magnitudes": pick(props["magnitudes"], idx),
+                "directions": pick(props["directions"], idx),
+                "dSep": props["dSep"],
+                "iSteps": props["iSteps"]
+                }
+        new_obj["features"].append({
+                "type": "Feature",
+                "id": x,
+                "properties": {},
+                "geometry": {"type": "LineString", "properties": nProps,
+                             "coordinates": pick(coords, idx)},
+                })
+    return new_obj
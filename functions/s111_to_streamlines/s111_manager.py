@@ -3,45 +3,341 @@ import json
 import os
 import boto3
 import time
+import shutil
+import tempfile
+import gzip
+import math
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DATA_DEST = os.getenv('DATA_DEST')
+CHUNK_SIZE = 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+CACHE_DIR = "/tmp/s111_cache"
+CACHE_BYTES = int(os.getenv('CACHE_BYTES', 256 * 1024 * 1024))
+WORKERS = int(os.getenv('WORKERS', os.cpu_count() or 1))
+STREAM_OUTPUT = os.getenv('STREAM_OUTPUT', '0') == '1'
+COMPACT_OUTPUT = os.getenv('COMPACT_OUTPUT', '0') == '1'
+COORD_PRECISION = int(os.getenv('COORD_PRECISION', 6))
+GZIP_OUTPUT = os.getenv('GZIP_OUTPUT', '0') == '1'
+GEOJSON_SEQ = os.getenv('GEOJSON_SEQ', '0') == '1'
+SIMPLIFY = os.getenv('SIMPLIFY', '0') == '1'
+SIMPLIFY_PIXELS = float(os.getenv('SIMPLIFY_PIXELS', 0.5))
+VERTEX_PROPS = ("magnitudes", "directions", "point_levels")
+ATTR_ENCODING = os.getenv('ATTR_ENCODING', 'float')
+# Deepest zoom json2mvt ever tiles to (its AUTO_MAX_ZOOM), used when
+# TILING_PROFILES, the json2mvt registry set in the template Globals,
+# gives a model no max zoom
+MAX_ZOOM = 18
+TILING_PROFILES = json.loads(os.getenv('TILING_PROFILES', '{}'))
+ATTR_SCALES = {
+    "magnitudes": int(os.getenv('MAGNITUDE_SCALE', 1000)),
+    "directions": int(os.getenv('DIRECTION_SCALE', 10)),
+    "point_levels": 1,
+}
+# Streamed output is the binary's own JSON, nothing can reshape it on the way
+if STREAM_OUTPUT and (COMPACT_OUTPUT or GZIP_OUTPUT or GEOJSON_SEQ or SIMPLIFY
+                      or ATTR_ENCODING != 'float'):
+    raise ValueError("STREAM_OUTPUT can't be combined with COMPACT_OUTPUT, GZIP_OUTPUT, "
+                     "GEOJSON_SEQ, SIMPLIFY or ATTR_ENCODING")
 s3 = boto3.client("s3")
 
 
-def run_s111(name, group):
+def stream_to_file(body, fp, chunk_size=CHUNK_SIZE):
+    """
+    Copy an S3 StreamingBody into fp in fixed-size chunks so the object is
+    never held in memory twice.
+    """
+    shutil.copyfileobj(body, fp, chunk_size)
+    fp.seek(0)
+    return fp
+
+
+def evict(keep):
+    """
+    Drop the least recently used cached files until the cache fits in
+    CACHE_BYTES. The file about to be used is never evicted.
+    """
+    files = [os.path.join(CACHE_DIR, f) for f in os.listdir(CACHE_DIR)]
+    files = sorted((os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files)
+    total = sum(size for _, size, _ in files)
+    for _, size, path in files:
+        if total <= CACHE_BYTES:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total -= size
+        print("Evicted:", path)
+
+
+def fetch_file(bucket, infile):
+    """
+    Return a /tmp path holding the S3 object, reusing the copy a previous
+    invocation of this container left behind if its ETag still matches.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    etag = s3.head_object(Bucket=bucket, Key=infile)["ETag"].strip('"')
+    path = os.path.join(CACHE_DIR, "%s-%s" % (etag, infile.replace("/", "_")))
+    if os.path.exists(path):
+        os.utime(path)
+        print("Cache hit:", path)
+        return path
+
+    print("Cache miss:", path)
+    obj = s3.get_object(Bucket=bucket, Key=infile, IfMatch=etag)
+    with open(path + ".part", "wb") as fp:
+        stream_to_file(obj["Body"], fp)
+    os.rename(path + ".part", path)
+    evict(path)
+    return path
+
+
+def run_s111(path, group):
     env = os.environ.copy()
     env["LD_LIBRARY_PATH"] = "/opt/lib/"
-    p = subprocess.Popen(["/opt/s111_to_streamlines", "/tmp/" + name, group],
+    p = subprocess.Popen(["/opt/s111_to_streamlines", path, group],
                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                          env=env)
     output = p.communicate()
-    return json.loads(output[0])
+    return json.loads(output[0]), len(output[0])
 
 
-def lambda_handler(event, context):
+def round_coords(coords, precision):
+    if isinstance(coords, float):
+        return round(coords, precision)
+    return [round_coords(c, precision) for c in coords]
 
-    data_path = event["Records"][0]["Sns"]["Message"].split("/")
-    print(data_path)
-    bucket = data_path[0]
-    infile = data_path[1]
-    group = data_path[2]
 
-    print("Processing:", bucket, infile, group)
-    obj = s3.get_object(Bucket=bucket, Key=infile)
-    body = obj["Body"].read()
-    with open("/tmp/%s" % infile, "wb") as fp:
-        fp.write(body)
+def zoom_tolerance(zoom, pixels=SIMPLIFY_PIXELS):
+    """Simplification tolerance in degrees of longitude for a zoom level"""
+    return pixels * 360.0 / (256 * 2 ** zoom)
 
-    outfile = infile + "/" + group + ".geojson"
 
-    streamlines = run_s111(infile, group)
-    output = json.dumps(streamlines, indent=4)
+def simplify_zoom(model):
+    """
+    Zoom to simplify a model's streamlines for: the deepest one json2mvt
+    builds for it. Tippecanoe simplifies every lower zoom on its own, so
+    nothing dropped here is visible at any tiled zoom.
+    """
+    name = model if model in TILING_PROFILES else next(
+        (m for m in TILING_PROFILES if m != "default" and m in model), "default")
+    profile = dict(TILING_PROFILES.get("default", {}))
+    profile.update(TILING_PROFILES.get(name, {}))
+    zoom = profile.get("max_zoom", MAX_ZOOM)
+    if zoom == "auto":
+        # json2mvt never resolves "auto" past auto_max
+        zoom = profile.get("auto_max", MAX_ZOOM)
+    return zoom
+
+
+def douglas_peucker(pts, starts, ends, tolerance):
+    """
+    Douglas-Peucker over many lines at once. pts holds every line's
+    vertices back to back, line i spanning starts[i]..ends[i]. Each pass
+    splits all open segments of all lines together, so the number of
+    NumPy passes follows the recursion depth, not the vertex count.
+    Returns the mask of vertices to keep.
+    """
+    keep = np.zeros(len(pts), dtype=bool)
+    keep[starts] = True
+    keep[ends] = True
+    s, e = starts, ends
+    while len(s):
+        inner = e - s - 1
+        open_ = inner > 0
+        s, e, inner = s[open_], e[open_], inner[open_]
+        if not len(s):
+            break
+        seg = np.repeat(np.arange(len(s)), inner)
+        offsets = np.cumsum(inner) - inner
+        idx = s[seg] + 1 + np.arange(inner.sum()) - offsets[seg]
+        a, b, p = pts[s[seg]], pts[e[seg]], pts[idx]
+        ab = b - a
+        ap = p - a
+        length = np.hypot(ab[:, 0], ab[:, 1])
+        cross = np.abs(ab[:, 0] * ap[:, 1] - ab[:, 1] * ap[:, 0])
+        dist = np.where(length > 0, cross / np.where(length > 0, length, 1),
+                        np.hypot(ap[:, 0], ap[:, 1]))
+        # farthest vertex of every segment: sort by segment, then distance
+        order = np.lexsort((-dist, seg))
+        first = order[offsets]
+        split = dist[first] > tolerance
+        mid = idx[first][split]
+        keep[mid] = True
+        s, e = np.concatenate((s[split], mid)), np.concatenate((mid, e[split]))
+    return keep
+
+
+def simplify(streamlines, zoom=MAX_ZOOM):
+    """
+    Drop vertices that are invisible at zoom, keeping the per-vertex
+    property arrays aligned with the surviving vertices.
+    Returns (vertices before, vertices after).
+    """
+    features = [f for f in streamlines.get("features", [])
+                if len(f["geometry"]["coordinates"]) > 2]
+    if np is None or not features:
+        return 0, 0
+    lengths = np.array([len(f["geometry"]["coordinates"]) for f in features])
+    ends = np.cumsum(lengths) - 1
+    starts = ends - lengths + 1
+    pts = np.array([c[:2] for f in features for c in f["geometry"]["coordinates"]], dtype=float)
+    # Work in web mercator pixel proportions around the data's latitude
+    pts[:, 1] /= math.cos(math.radians(pts[:, 1].mean()))
+    keep = douglas_peucker(pts, starts, ends, zoom_tolerance(zoom))
+
+    counts = np.add.reduceat(keep, starts)
+    local = (np.flatnonzero(keep) - np.repeat(starts, counts)).tolist()
+    bounds = np.concatenate(([0], np.cumsum(counts))).tolist()
+    for i, f in enumerate(features):
+        pick = itemgetter(*local[bounds[i]:bounds[i + 1]])
+        f["geometry"]["coordinates"] = list(pick(f["geometry"]["coordinates"]))
+        for name in VERTEX_PROPS:
+            if name in f["properties"]:
+                f["properties"][name] = list(pick(f["properties"][name]))
+    return int(lengths.sum()), int(counts.sum())
+
 
+def encode_attributes(streamlines, encoding=ATTR_ENCODING):
+    """
+    Shrink the per-vertex property arrays, see "Streamline attribute
+    encoding" in the README for the decode contract.
+    "quantized": each value becomes round(value * scale).
+    "delta": the quantized values are written as a comma separated
+    string holding the first value followed by successive differences.
+    """
+    if encoding == "float":
+        return
+    if encoding not in ("quantized", "delta"):
+        raise ValueError("Unknown ATTR_ENCODING: %s" % encoding)
+    for feature in streamlines.get("features", []):
+        props = feature["properties"]
+        for name in VERTEX_PROPS:
+            if name not in props:
+                continue
+            scale = ATTR_SCALES[name]
+            values = [int(round(v * scale)) for v in props[name]]
+            if encoding == "delta":
+                values = ",".join(str(v - p) for p, v in zip([0] + values, values))
+            props[name] = values
+            props[name + "_scale"] = scale
+        props["attr_encoding"] = encoding
 
 
+def serialize(streamlines):
+    """
+    Encode the streamlines for Bucket2. The compact form drops all
+    whitespace and rounds coordinates to COORD_PRECISION decimals, the
+    GeoJSONSeq form writes one feature per line so tippecanoe can read
+    it in parallel.
+    """
+    if COMPACT_OUTPUT:
+        for feature in streamlines.get("features", []):
+            geometry = feature["geometry"]
+            geometry["coordinates"] = round_coords(geometry["coordinates"], COORD_PRECISION)
+    if GEOJSON_SEQ:
+        # Each feature must sit on a single line, so never indent here
+        lines = [json.dumps(f, separators=(",", ":")) for f in streamlines.get("features", [])]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+    if COMPACT_OUTPUT:
+        return json.dumps(streamlines, separators=(",", ":")).encode("utf-8")
+    return json.dumps(streamlines, indent=4).encode("utf-8")
+
+
+def stream_s111(path, group, outfile):
+    """
+    Pipe s111_to_streamlines stdout straight into a multipart S3 upload,
+    so the streamline JSON is never held in memory as a whole. The upload
+    is only completed once the binary exits cleanly, a failed run aborts
+    it so no truncated object ever reaches DATA_DEST.
+    """
+    env = os.environ.copy()
+    env["LD_LIBRARY_PATH"] = "/opt/lib/"
+    upload = s3.create_multipart_upload(Bucket=DATA_DEST, Key=outfile)
+    try:
+        with tempfile.TemporaryFile(dir="/tmp") as err:
+            p = subprocess.Popen(["/opt/s111_to_streamlines", path, group],
+                                 stdout=subprocess.PIPE, stderr=err,
+                                 env=env)
+            parts = []
+            with p.stdout:
+                # Every part but the last must be at least 5 MiB
+                for chunk in iter(lambda: p.stdout.read(PART_SIZE), b""):
+                    res = s3.upload_part(Bucket=DATA_DEST, Key=outfile,
+                                         UploadId=upload["UploadId"],
+                                         PartNumber=len(parts) + 1,
+                                         Body=chunk)
+                    parts.append({"ETag": res["ETag"], "PartNumber": len(parts) + 1})
+            if p.wait() != 0 or not parts:
+                err.seek(0)
+                raise RuntimeError("s111_to_streamlines failed on %s: %s" %
+                                   (group, err.read().decode("utf-8", "replace")))
+        s3.complete_multipart_upload(Bucket=DATA_DEST, Key=outfile,
+                                     UploadId=upload["UploadId"],
+                                     MultipartUpload={"Parts": parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=DATA_DEST, Key=outfile,
+                                  UploadId=upload["UploadId"])
+        raise
+
+
+def process_group(path, infile, group):
+    outfile = infile + "/" + group + ".geojson"
+
+    if STREAM_OUTPUT:
+        stream_s111(path, group, outfile)
+        print("Streamed:", outfile)
+        return
+
+    if GEOJSON_SEQ:
+        # json2mvt switches tippecanoe to parallel reads on this extension
+        outfile += "s"
+    streamlines, raw_size = run_s111(path, group)
+    if SIMPLIFY:
+        zoom = simplify_zoom(infile)
+        before, after = simplify(streamlines, zoom)
+        print("Simplified %s for z%d: %d -> %d vertices (%.1f%% kept)" %
+              (group, zoom, before, after, 100.0 * after / max(before, 1)))
+    encode_attributes(streamlines)
+    output = serialize(streamlines)
+    extra = {}
+    if GZIP_OUTPUT:
+        output = gzip.compress(output)
+        extra["ContentEncoding"] = "gzip"
+
     s3.put_object(Bucket=DATA_DEST,
                   Key=outfile,
-                  Body=output.encode("utf-8"))
+                  Body=output,
+                  **extra)
+    # raw_size is the binary's own output, not the indent=4 default, so
+    # report both rather than a misleading difference
+    print("Uploaded: %s %d bytes (s111_to_streamlines wrote %d)" %
+          (outfile, len(output), raw_size))
+
+
+def lambda_handler(event, context):
+
+    data_path = event["Records"][0]["Sns"]["Message"].split("/")
+    print(data_path)
+    bucket = data_path[0]
+    infile = data_path[1]
+    # A message may carry a comma separated batch of groups of one file
+    groups = data_path[2].split(",")
+
+    print("Processing:", bucket, infile, groups)
+    path = fetch_file(bucket, infile)
+
+    # Each worker thread drives one s111_to_streamlines process, so at most
+    # WORKERS (the vCPU count by default) run at once
+    with ThreadPoolExecutor(max_workers=min(WORKERS, len(groups))) as executor:
+        for _ in executor.map(lambda g: process_group(path, infile, g), groups):
+            pass
 
     return {
         'statusCode': 200,
@@ -1,68 +1,218 @@
 import os
 import boto3
 import base64
+import time
+import gzip
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 dynamodb = boto3.client('dynamodb')
 s3_client = boto3.client("s3")
 DATA_TABLE = os.getenv('DATA_TABLE')
 DATA_BUCKET = os.getenv('DATA_BUCKET')
 TIME_TABLE = os.getenv("TIME_TABLE")
+TILE_CACHE_BYTES = int(os.getenv("TILE_CACHE_BYTES", 64 * 1024 * 1024))
+BLOB_CACHE_BYTES = int(os.getenv("BLOB_CACHE_BYTES", 32 * 1024 * 1024))
+TIME_CACHE_TTL = float(os.getenv("TIME_CACHE_TTL", 60))
 
 
-def lambda_handler(event, context):
-    region = event["pathParameters"]["region"]
-    t = event["pathParameters"]["t"]
-    z = event["pathParameters"]["z"]
-    x = event["pathParameters"]["x"]
-    y = os.path.splitext(event["pathParameters"]["y"])[0]
-    table_index = "{}-{}-{}-{}-{}".format(region, t, z, x, y)
-    print(table_index)
+class ByteLRU:
+    """
+    LRU cache of (payload, codec) pairs bounded by the total payload size
+    rather than entry count. Contents survive between warm invocations.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return data
+
+    def put(self, key, value):
+        if len(value[0]) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.stats["bytes"] -= len(self.entries.pop(key)[0])
+        self.entries[key] = value
+        self.stats["bytes"] += len(value[0])
+        while self.stats["bytes"] > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.stats["bytes"] -= len(old[0])
+            self.stats["evictions"] += 1
+
+
+# Keys are (table_index, last_updated) so a new forecast never serves stale tiles
+tile_cache = ByteLRU(TILE_CACHE_BYTES)
+# Deduplicated tile blobs are immutable, so they are keyed by hash alone
+blob_cache = ByteLRU(BLOB_CACHE_BYTES)
+
+# last_updated stamps only change when h5_query ingests a new forecast,
+# so they are held for TIME_CACHE_TTL seconds: region -> (stamp, expiry)
+time_cache = {}
+
+
+def cached_last_updated(region):
+    cached = time_cache.get(region)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def batch_lookup(region, table_index):
+    """
+    Fetch the tile item and the region's last_updated stamp in a single
+    BatchGetItem round trip instead of two serial get_item calls.
+    """
+    request = {
+        DATA_TABLE: {"Keys": [{"tileKey": {"S": table_index}}]},
+        TIME_TABLE: {"Keys": [{"dataset": {"S": region}}]},
+    }
+    tile = None
+    last_updated = None
+    while request:
+        res = dynamodb.batch_get_item(RequestItems=request)
+        for item in res["Responses"].get(DATA_TABLE, []):
+            tile = item
+        for item in res["Responses"].get(TIME_TABLE, []):
+            last_updated = item["last_updated"]["S"]
+        request = res.get("UnprocessedKeys")
+    if last_updated is None:
+        time_cache.pop(region, None)
+    else:
+        time_cache[region] = (last_updated, time.monotonic() + TIME_CACHE_TTL)
+    return tile, last_updated
+
+
+def get_blob(digest):
+    """
+    Resolve a deduplicated tile body stored under blob-<hash> by mbutil.
+    Returns (payload, codec), or None if the blob item has not landed yet.
+    """
+    value = blob_cache.get(digest)
+    if value is not None:
+        return value
+    blob_key = "blob-" + digest
     res = dynamodb.get_item(
         TableName=DATA_TABLE,
         Key={
             "tileKey": {
-                "S": table_index
+                "S": blob_key
             }
         }
     )
     if "Item" not in res:
-        return {
-            'statusCode': 204,
-            "headers": {
-                "Content-Type": "application/x-protobuf",
-                "Content-Encoding": "gzip",
-                "Access-Control-Allow-Origin": "*",
-            }
-
-        }
-    time = dynamodb.get_item(
-        TableName=TIME_TABLE, Key={"dataset": {"S": region}}
-    )
-    if "Item" not in time or (
-            time["Item"]["last_updated"]["S"] != res["Item"]["timestamp"]["S"]):
-        return {
-            'statusCode': 204,
-            "headers": {
-                "Content-Type": "application/x-protobuf",
-                "Access-Control-Allow-Origin": "*",
-                "Content-Encoding": "gzip",
-            }
-        }
+        return None
     if res["Item"]["huge"]["BOOL"]:
         s3_obj = s3_client.get_object(
             Bucket=DATA_BUCKET,
-            Key=table_index
+            Key=blob_key
         )
         data = s3_obj["Body"].read()
     else:
         data = res["Item"]["tile"]["B"]
+    value = (data, item_codec(res["Item"]))
+    blob_cache.put(digest, value)
+    return value
+
+
+def item_codec(item):
+    # Items written before codecs were recorded hold tippecanoe's gzip tiles
+    return item.get("codec", {"S": "gzip"})["S"]
+
+
+def negotiate(data, codec, accept):
+    """
+    Serve the stored encoding when the client accepts it, otherwise fall
+    back to gzip, which every map client understands.
+    """
+    if codec == "gzip" or codec in accept:
+        return data, codec
+    if zstandard is None:
+        raise RuntimeError("%s tile needs the zstandard package to transcode" % codec)
+    return gzip.compress(zstandard.ZstdDecompressor().decompress(data)), "gzip"
+
+
+def no_content():
+    return {
+        'statusCode': 204,
+        "headers": {
+            "Content-Type": "application/x-protobuf",
+            "Content-Encoding": "gzip",
+            "Access-Control-Allow-Origin": "*",
+        }
+    }
+
+
+def lambda_handler(event, context):
+    region = event["pathParameters"]["region"]
+    t = event["pathParameters"]["t"]
+    z = event["pathParameters"]["z"]
+    x = event["pathParameters"]["x"]
+    y = os.path.splitext(event["pathParameters"]["y"])[0]
+    table_index = "{}-{}-{}-{}-{}".format(region, t, z, x, y)
+    print(table_index)
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    accept = headers.get("accept-encoding", "")
+    last_updated = cached_last_updated(region)
+    value = None
+    if last_updated is not None:
+        value = tile_cache.get((table_index, last_updated))
+    if value is None:
+        if last_updated is None:
+            # No stamp to key the cache with, so this is a miss too
+            tile_cache.stats["misses"] += 1
+            tile, last_updated = batch_lookup(region, table_index)
+        else:
+            tile = dynamodb.get_item(
+                TableName=DATA_TABLE,
+                Key={
+                    "tileKey": {
+                        "S": table_index
+                    }
+                }
+            ).get("Item")
+            if tile is not None and last_updated != tile["timestamp"]["S"]:
+                # The tile may be newer than our cached stamp, re-check next time
+                time_cache.pop(region, None)
+        if (last_updated is None or tile is None or
+                last_updated != tile["timestamp"]["S"]):
+            print("Cache:", tile_cache.stats)
+            return no_content()
+        if "hash" in tile:
+            value = get_blob(tile["hash"]["S"])
+            if value is None:
+                return no_content()
+        elif tile["huge"]["BOOL"]:
+            s3_obj = s3_client.get_object(
+                Bucket=DATA_BUCKET,
+                Key=table_index
+            )
+            value = (s3_obj["Body"].read(), item_codec(tile))
+        else:
+            value = (tile["tile"]["B"], item_codec(tile))
+        tile_cache.put((table_index, last_updated), value)
+    data, codec = negotiate(value[0], value[1], accept)
+    print("Cache:", tile_cache.stats, "Blobs:", blob_cache.stats)
     return {
         "isBase64Encoded": True,
         "statusCode": 200,
         "headers": {
             "Content-Type": "application/x-protobuf",
-            "Content-Encoding": "gzip",
+            "Content-Encoding": codec,
             "Access-Control-Allow-Origin": "*",
+            "Vary": "Accept-Encoding",
         },
         "body":  base64.b64encode(data).decode("utf-8"),
     }
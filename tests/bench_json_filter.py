@@ -0,0 +1,59 @@
+"""
+Benchmark mbutil.json_filter against the NumPy json_filter_np.
+
+Runs the bundled s111_to_streamlines binary over every group of
+events/S111US_20191023T17Z_NYOFS_TYP2.h5, merges the streamlines into one
+FeatureCollection, checks both filters agree and times them.
+
+    python tests/bench_json_filter.py [repeats]
+"""
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER = os.path.join(ROOT, "dependencies", "s111_layer")
+EVENT = os.path.join(ROOT, "events", "S111US_20191023T17Z_NYOFS_TYP2.h5")
+
+sys.path.insert(0, os.path.join(ROOT, "functions", "json2mvt"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+from mbutil import json_filter, json_filter_np  # noqa: E402
+
+
+def streamlines():
+    env = os.environ.copy()
+    env["LD_LIBRARY_PATH"] = os.path.join(LAYER, "lib")
+    merged = {"type": "FeatureCollection", "bbox": [], "features": []}
+    group = 1
+    while True:
+        p = subprocess.run([os.path.join(LAYER, "s111_to_streamlines"), EVENT,
+                            "Group_%03d" % group],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+        if p.returncode != 0 or not p.stdout:
+            break
+        obj = json.loads(p.stdout)
+        merged["bbox"] = obj["bbox"]
+        merged["features"] += obj["features"]
+        group += 1
+    return merged, group - 1
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    obj, groups = streamlines()
+    vertices = sum(len(f["geometry"]["coordinates"]) for f in obj["features"])
+    print("%d groups, %d features, %d vertices" % (groups, len(obj["features"]), vertices))
+
+    assert json_filter(obj) == json_filter_np(obj), "json_filter_np disagrees with json_filter"
+
+    py = min(timeit.repeat(lambda: json_filter(obj), number=1, repeat=repeats))
+    vec = min(timeit.repeat(lambda: json_filter_np(obj), number=1, repeat=repeats))
+    print("json_filter    %.1f ms" % (py * 1000))
+    print("json_filter_np %.1f ms" % (vec * 1000))
+    print("speedup        %.2fx" % (py / vec))
+
+
+if __name__ == "__main__":
+    main()